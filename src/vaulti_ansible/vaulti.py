@@ -52,14 +52,16 @@ Thanks to Nebucatnetzer for refactoring!
 from __future__ import annotations
 
 import argparse
+import copy
+import functools
 import logging
 import os
 import subprocess
 import sys
 import tempfile
-import re
 
 from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 from typing import BinaryIO
@@ -107,7 +109,9 @@ from ansible.parsing.dataloader import DataLoader
 from ansible.parsing.vault import AnsibleVaultError
 from ansible.parsing.vault import (VaultLib, VaultSecret)
 
+from ruamel.yaml import MappingNode
 from ruamel.yaml import ScalarNode
+from ruamel.yaml import SequenceNode
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import (
     CommentedBase,
@@ -119,6 +123,7 @@ from ruamel.yaml.compat import StringIO
 from ruamel.yaml.constructor import (RoundTripConstructor, DuplicateKeyError, ConstructorError)
 from ruamel.yaml.error import StringMark  # To be able to insert newlines where needed
 from ruamel.yaml.parser import ParserError
+from ruamel.yaml.representer import RoundTripRepresenter
 from ruamel.yaml.scanner import ScannerError
 from ruamel.yaml.tokens import (
     CommentToken,
@@ -135,8 +140,21 @@ TAG_NAME_INVALID_VAULT_FORMAT = "!VAULT_FORMAT_ERROR"
 TAG_NAME_UNKNOWN_LABEL = "!UNKNOWN_VAULT_ID_LABEL"
 TAG_SEPARATOR_VAULTID = ":" # The symbol to denote the ansible-vault id
 
+# The only node types compare_and_update can do anything with; everything else is kept as is
+_COMPARABLE_TYPES = (CommentedMap, CommentedSeq, TaggedScalar)
+
+# All this just to make a newline after vaulted values... not 100% sure how this StringMark stuff
+# works, but the same newline comment works everywhere, so only build it once
+_NEWLINE_START_MARK = StringMark(buffer=None, pointer=0, name=None, index=0, line=0, column=0)
+_NEWLINE_END_MARK = StringMark(buffer=None, pointer=1, name=None, index=1, line=0, column=1)
+_NEWLINE_TOKEN = CommentToken("\n", start_mark=_NEWLINE_START_MARK, end_mark=_NEWLINE_END_MARK)
+
+# Buffer size when dumping yaml straight to a file; the emitter writes in lots of small pieces
+_WRITE_BUFFER_SIZE = 1 << 20
+# Number of decrypted values to remember. Files with more than this are not decrypted in parallel
+_DECRYPT_CACHE_SIZE = 4096
+
 StreamType = Union[BinaryIO, IO[str], StringIO]
-VAULT = None
 
 def setup_vault(ask_vault_pass: bool, vault_password_file: str = None,
                 vault_ids: list = None) -> VaultLib:
@@ -145,17 +163,19 @@ def setup_vault(ask_vault_pass: bool, vault_password_file: str = None,
     logger = logging.getLogger("Vaulti")
 
     # If custom vault ids are specified (as parameters on the command line), use them
+    # (copied, so neither the arguments nor the ansible configuration are changed below)
     if vault_ids:
-        vault_ids_final = args.vault_id
+        vault_ids_final = list(vault_ids)
     # if not, just go with the default (based on environment variables and ansible.cfg)
-    else: 
+    else:
         # This variable might exist, depending on the ansible configuration. Ignore it with pylint
-        vault_ids_final = C.DEFAULT_VAULT_IDENTITY_LIST  # pylint: disable=no-member
+        vault_ids_final = list(C.DEFAULT_VAULT_IDENTITY_LIST)  # pylint: disable=no-member
 
     # If a vault password file is specified, add it to the default id
     if vault_password_file:
         logger.info("Vault password file specified as parameter, adding it as the default vault id")
-        vault_ids.append(f"@{vault_password_file}")
+        vault_ids_final.append(f"@{vault_password_file}")
+    logger.debug("Using vault ids: %s", vault_ids_final)
 
     # Set up vault
     try:
@@ -177,38 +197,115 @@ def get_secret_for_vault_id(vault_lib: VaultLib, vault_id: str) -> VaultSecret:
     Useful for when you want to check whether you have actually added the vault-id at all
     (as opposed to added it, but typed the wrong password)
     """
-    # Access the _secrets attribute to get the dictionary of vault secrets
-    vault_secrets = vault_lib.secrets  # This is a list of tuples (vault_id, VaultSecret)
-
-    for id_label, secret in vault_secrets:
-        if id_label == vault_id:
-            return secret
+    # This is called for every encrypted variable, so index the secrets by vault-id once instead
+    # of searching through them every time. The index is kept on the VaultLib object itself.
+    # pylint: disable=protected-access
+    secrets_by_id = getattr(vault_lib, "_vaulti_secrets_by_id", None)
+    if secrets_by_id is None:
+        secrets_by_id = {}
+        # This is a list of tuples (vault_id, VaultSecret). Keep the first one if an id is
+        # repeated, since that is the one a search would find
+        for id_label, secret in vault_lib.secrets:
+            secrets_by_id.setdefault(id_label, secret)
+        vault_lib._vaulti_secrets_by_id = secrets_by_id
 
-    raise ValueError(f"Vault secret with vault-id '{vault_id}' not found.")
+    try:
+        return secrets_by_id[vault_id]
+    except KeyError:
+        raise ValueError(f"Vault secret with vault-id '{vault_id}' not found.") from None
 
+@functools.lru_cache(maxsize=4096)
 def extract_vault_label(vaulttext: str) -> str:
     """Extracts the label from the Vault ID line in the encrypted data.
     Returns an empty string if the default vault-id is used"""
-    first_line = vaulttext.splitlines()[0]
-    parts = first_line.split(";")
-    if len(parts) >= 4:
-        return parts[3]  # This is the label
-    return ""  # Return "" if no label is present
-
-def constructor_tmp_decrypt(_: RoundTripConstructor, node: ScalarNode) -> TaggedScalar:
+    # Only the header line is interesting, so just look for the separators in that line
+    # ($ANSIBLE_VAULT;version;cipher;label) without splitting anything into lists
+    end_of_line = vaulttext.find("\n")
+    if end_of_line < 0:
+        end_of_line = len(vaulttext)
+    start = 0
+    for _ in range(3):
+        start = vaulttext.find(";", start, end_of_line) + 1
+        if start == 0:
+            return ""  # Return "" if no label is present
+    end = vaulttext.find(";", start, end_of_line)
+    return vaulttext[start:end if end >= 0 else end_of_line]  # This is the label
+
+@functools.lru_cache(maxsize=_DECRYPT_CACHE_SIZE)
+def _decrypt_cached(vault: VaultLib, vaulttext: str) -> bytes:
+    """Decrypts a vault string, remembering the result. Decrypting is expensive (key derivation),
+    and the same ciphertext is often decrypted more than once; when it is repeated in the file, and
+    when comparing the edited data with the original data. Failures are not cached, so the
+    exceptions are raised every time."""
+    return vault.decrypt(vaulttext)
+
+def _try_decrypt_cached(vault: VaultLib, vaulttext: str) -> None:
+    """Fills the decrypt cache for one vault string. The constructor reports any errors"""
+    try:
+        _decrypt_cached(vault, vaulttext)
+    except AnsibleError:
+        pass
+
+def prefetch_vault_values(node: Any, vault: VaultLib) -> None:
+    """Decrypts all the !vault values of a composed document in parallel, before the document is
+    constructed. The key derivation is what makes decrypting slow, and it does not hold the GIL,
+    so a few threads get through files with many encrypted values a lot quicker. The results end
+    up in the decrypt cache, where the constructor picks them up."""
+    workers = min(32, os.cpu_count() or 1)
+    vaulttexts = set()
+    seen = set()
+    to_process = [node]
+    while to_process:
+        current = to_process.pop()
+        if current is None or id(current) in seen:
+            continue
+        seen.add(id(current))
+        if isinstance(current, ScalarNode):
+            if current.tag == "!vault":
+                vaulttexts.add(current.value)
+        elif isinstance(current, MappingNode):
+            for key_node, value_node in current.value:
+                to_process.append(key_node)
+                to_process.append(value_node)
+        elif isinstance(current, SequenceNode):
+            to_process.extend(current.value)
+
+    # Not worth starting threads for, the constructor will decrypt these itself. If there are more
+    # values than the cache can hold, the first ones are evicted again before they are constructed
+    if workers < 2 or not 2 <= len(vaulttexts) <= _DECRYPT_CACHE_SIZE:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(vaulttexts))) as executor:
+        # Consume the iterator so the threads are done before constructing
+        list(executor.map(functools.partial(_try_decrypt_cached, vault), vaulttexts))
+
+def constructor_tmp_decrypt(constructor: RoundTripConstructor, node: ScalarNode) -> TaggedScalar:
     """Constructor to translate encrypted values to decrypted values when loading yaml
     before opening the editor. When encountering issues, it will not decrypt, but
     temporarily change the tag to indicate what went wrong.
     """
 
     logger = logging.getLogger("Vaulti")
+    vault = constructor.vault
     label = extract_vault_label(node.value)
+    has_label = label != ""
+
+    def tagged(value: str, style: str, tag: str) -> TaggedScalar:
+        """Every outcome is a TaggedScalar keeping the anchor of the original node. It also
+        remembers the original !vault value, so it can be compared with the edited value later
+        without having to load the file again"""
+        taggedscalar = TaggedScalar(value=value, style=style, tag=tag)
+        taggedscalar.yaml_set_anchor(node.anchor)
+        original_vault = TaggedScalar(value=node.value, style=node.style, tag="!vault")
+        original_vault.yaml_set_anchor(node.anchor)
+        taggedscalar.original_vault = original_vault
+        return taggedscalar
 
     try:
-        # pylint: disable=possibly-used-before-assignment
-        decrypted_value = VAULT.decrypt(vaulttext=node.value).decode("utf-8")
+        # Go through the cache, so repeated ciphertexts (shared secrets) are only decrypted once,
+        # and so the comparison after editing doesn't have to decrypt the originals again
+        decrypted_value = _decrypt_cached(vault, node.value).decode("utf-8")
 
-        if label != "":
+        if has_label:
             decrypted_tag_with_label = f"{TAG_NAME_DECRYPTED_SUCCESS}{TAG_SEPARATOR_VAULTID}{label}"
             logger.info("Decrypted variable with the vault-id %s", label)
         else:
@@ -216,211 +313,248 @@ def constructor_tmp_decrypt(_: RoundTripConstructor, node: ScalarNode) -> Tagged
             logger.info("Decrypted variable with the default vault-id")
 
         # Make it easier to read decrypted variables with newlines in it
-        if "\n" in decrypted_value:
-            logger.info("Printing multiline variable with newlines for easy reading/editing")
-            taggedscalar = TaggedScalar(
-                value=decrypted_value, style="|", tag=decrypted_tag_with_label
-            )
-            taggedscalar.yaml_set_anchor(node.anchor)
-            return taggedscalar
-
-        logger.info("Decrypted variable with the default vault-id")
-        taggedscalar = TaggedScalar(value=decrypted_value, style="", tag=decrypted_tag_with_label)
-        taggedscalar.yaml_set_anchor(node.anchor)
-        return taggedscalar
+        style = "|" if "\n" in decrypted_value else ""
+        return tagged(decrypted_value, style, decrypted_tag_with_label)
 
     except AnsibleVaultError:
         # If there is no label, it is probably just a variable encrypted with the wrong key
 
-        if label == "":
+        if not has_label:
             logger.info("Could not decrypt variable with default vault id")
-            taggedscalar = TaggedScalar(value=node.value, style="|", tag=TAG_NAME_COULD_NOT_DECRYPT)
-            taggedscalar.yaml_set_anchor(node.anchor)
-            return taggedscalar
+            return tagged(node.value, "|", TAG_NAME_COULD_NOT_DECRYPT)
         # If there is a label, it is probably because you just forgot to load the vault id,
         # and the temporary tag name might give you a hint
 
         try:
             # Try this and see if it fails, we dont care about what it returns
-            get_secret_for_vault_id(VAULT, label)
+            get_secret_for_vault_id(vault, label)
             # If you did load the vault-id and it still failed, it is probably
             # just the wrong password
             logger.info("Could not decrypt variable")
-            taggedscalar = TaggedScalar(value=node.value, style="|", tag=TAG_NAME_COULD_NOT_DECRYPT)
-            taggedscalar.yaml_set_anchor(node.anchor)
-            return taggedscalar
+            return tagged(node.value, "|", TAG_NAME_COULD_NOT_DECRYPT)
         except ValueError:
             # If you did not load it, mention that using the tag
             logger.info("Could not decrypt variable, vault-id %s not loaded", label)
-            taggedscalar = TaggedScalar(
-                value=node.value, style="|",
-                tag=f"{TAG_NAME_UNKNOWN_LABEL}{TAG_SEPARATOR_VAULTID}{label}"
+            return tagged(
+                node.value, "|", f"{TAG_NAME_UNKNOWN_LABEL}{TAG_SEPARATOR_VAULTID}{label}"
             )
-            taggedscalar.yaml_set_anchor(node.anchor)
-            return taggedscalar
 
     except AnsibleError:
         # If the format is wrong, add that as a separate tag
         logger.info("Could not decrypt variable with invalid format")
-        taggedscalar = TaggedScalar(value=node.value, style="|", tag=TAG_NAME_INVALID_VAULT_FORMAT)
-        taggedscalar.yaml_set_anchor(node.anchor)
-        return taggedscalar
-
+        return tagged(node.value, "|", TAG_NAME_INVALID_VAULT_FORMAT)
+
+
+# The abstract comment methods are never called on a tagged scalar, TaggedScalar doesn't have them
+class PendingEncryption(TaggedScalar):  # pylint: disable=abstract-method
+    """A !vault value which hasn't been encrypted yet. Encrypting is expensive, and most values are
+    usually unchanged after editing, in which case compare_and_update() replaces them with their
+    original encrypted value anyway. So only encrypt when the value is actually needed (for example
+    when it is written to the file)."""
+
+    def __init__(self, plaintext: str, vault: VaultLib, secret: VaultSecret, vault_id: str) -> None:
+        self.plaintext = plaintext
+        self.vault = vault
+        self.secret = secret
+        self.vault_id = vault_id
+        super().__init__(value=None, style="|", tag="!vault")
+
+    @property
+    def value(self) -> str:
+        """The encrypted value, encrypting it the first time it is used"""
+        if self._vaulttext is None:
+            # Seems to need explicit values for secret and vault_id even when you just want the
+            # default, It seems to just select the first VaultSecret object otherwise, which is
+            # rarely default.
+            self._vaulttext = self.vault.encrypt(
+                plaintext=self.plaintext, secret=self.secret, vault_id=self.vault_id
+            ).decode("utf-8")
+        return self._vaulttext
+
+    @value.setter
+    def value(self, value: str) -> None:
+        self._vaulttext = value
+
+
+# Dump it exactly like any other tagged scalar
+RoundTripRepresenter.add_representer(
+    PendingEncryption, RoundTripRepresenter.represent_tagged_scalar
+)
 
 
 def constructor_tmp_encrypt(
-        _: RoundTripConstructor, node: ScalarNode, tag_suffix: str = None
+        constructor: RoundTripConstructor,
+        node_or_suffix: Union[ScalarNode, str],
+        node: ScalarNode = None,
     ) -> TaggedScalar:
     """Constructor to reencrypt values. Will look for vault-id labels in the tag, otherwise
     just uses the default vault-id to encrypt.
+
+    Registered both as a regular constructor, which is called with just the node, and as a
+    multiconstructor, which is called with the tag suffix (the vault-id label) and the node.
+    Handling both directly saves a wrapper function call for every encrypted variable.
     """
 
-    if tag_suffix is None:
-        secret = get_secret_for_vault_id(VAULT, "default")
+    if node is None:
+        node = node_or_suffix
         vault_id = "default"
     else:
-        secret = get_secret_for_vault_id(VAULT, tag_suffix)
-        vault_id = tag_suffix
-
-    # Seems to need explicit values for secret and vault_id even when you just want the default,
-    # It seems to just select the first VaultSecret object otherwise, which is rarely default.
-    encrypted_value = VAULT.encrypt(
-        plaintext=node.value, secret=secret, vault_id=vault_id
-    ).decode("utf-8")
-
-    taggedscalar = TaggedScalar(value=encrypted_value, style="|", tag="!vault")
+        vault_id = node_or_suffix
+    # Look up the secret right away, so a vault-id which hasn't been loaded is reported while the
+    # user can still fix it in the editor
+    vault = constructor.vault
+    secret = get_secret_for_vault_id(vault, vault_id)
+
+    taggedscalar = PendingEncryption(
+        plaintext=node.value, vault=vault, secret=secret, vault_id=vault_id
+    )
     taggedscalar.yaml_set_anchor(node.anchor)
     return taggedscalar
 
 
-def constructor_tmp_invalid(_: RoundTripConstructor, node: ScalarNode) -> TaggedScalar:
+def constructor_tmp_invalid(
+        _: RoundTripConstructor, node_or_suffix: Union[ScalarNode, str], node: ScalarNode = None
+    ) -> TaggedScalar:
     """ The invalid tag should just be translated directly back to the original tag and value.
     Useful for when we are using custom tags, or when you don't want the !vault value to be changed
+
+    Like constructor_tmp_encrypt(), this works both as a regular constructor and as a
+    multiconstructor. The tag suffix is not used here, the tag always goes back to !vault.
     """
+    if node is None:
+        node = node_or_suffix
     taggedscalar = TaggedScalar(value=node.value, style="|", tag="!vault")
     taggedscalar.yaml_set_anchor(node.anchor)
     return taggedscalar
 
 
-
-def is_commented_map(data: Any) -> bool:
-    """Helper function for readability"""
-    return isinstance(data, CommentedMap)
-
-
-def is_commented_seq(data: Any) -> bool:
-    """Helper function for readability"""
-    return isinstance(data, CommentedSeq)
-
-
-def is_tagged_scalar(data: Any) -> bool:
-    """Helper function for readability"""
-    return isinstance(data, TaggedScalar)
-
-
 def _process_commented_map(
-    original_data: CommentedMap, reencrypted_data: CommentedMap
-) -> tuple[CommentedMap, CommentedMap]:
-    """Helper function for compare_and_update. Loops over keys in a dict"""
-    for key in reencrypted_data:
-        if (
-            is_tagged_scalar(reencrypted_data[key])
-            and reencrypted_data[key].tag.value == "!vault"
-        ):
+    original_data: CommentedMap, reencrypted_data: CommentedMap, to_process: list, vault: VaultLib
+) -> None:
+    """Helper function for compare_and_update. Loops over keys in a dict, comparing the vaulted
+    values directly and adding nested dicts and lists to the list of nodes left to process"""
+    for key, value in reencrypted_data.items():
+        if isinstance(value, TaggedScalar) and value.tag.value == "!vault":
             ensure_newline(reencrypted_data, key)
-        if key in original_data:
-            # If ansible vault fails, use the new data instead of crashing
-            try:
-                reencrypted_data[key] = compare_and_update(
-                    original_data=original_data[key],
-                    reencrypted_data=reencrypted_data[key],
-                )
-            except (AnsibleError, AnsibleVaultError):
-                reencrypted_data[key] = reencrypted_data[key]
-    return original_data, reencrypted_data
+        # Plain values are always kept as they are, so don't bother looking at them
+        if key not in original_data or not isinstance(value, _COMPARABLE_TYPES):
+            continue
+        if not isinstance(value, TaggedScalar):
+            to_process.append((original_data[key], value))
+            continue
+        # If ansible vault fails, use the new data instead of crashing
+        try:
+            result = _compare_vaulted_value(original_data[key], value, vault)
+        except (AnsibleError, AnsibleVaultError):
+            continue
+        # Only replacing an existing key, so the dict can still be iterated
+        if result is not value:
+            reencrypted_data[key] = result
 
 
 def _process_commented_seq(
-    original_data: CommentedSeq, reencrypted_data: CommentedSeq
-) -> tuple[CommentedSeq, CommentedSeq]:
-    """Helper function for compare_and_update. Loops over items in a list"""
-    # Won't use enumerate for now, doesn't seem to be too easy to implement in the middle of this
-    # recursive logic
-    for i in range(len(reencrypted_data)): # pylint: disable=consider-using-enumerate
-        if (
-            is_tagged_scalar(reencrypted_data[i])
-            and reencrypted_data[i].tag.value == "!vault"
-        ):
+    original_data: CommentedSeq, reencrypted_data: CommentedSeq, to_process: list, vault: VaultLib
+) -> None:
+    """Helper function for compare_and_update. Loops over items in a list, comparing the vaulted
+    values directly and adding nested dicts and lists to the list of nodes left to process"""
+    original_length = len(original_data)
+    for i, item in enumerate(reencrypted_data):
+        if isinstance(item, TaggedScalar) and item.tag.value == "!vault":
             ensure_newline(reencrypted_data, str(i))
+        # New items have nothing to be compared with, and plain values are always kept as they
+        # are, so just keep them
+        if i >= original_length or not isinstance(item, _COMPARABLE_TYPES):
+            continue
+        if not isinstance(item, TaggedScalar):
+            to_process.append((original_data[i], item))
+            continue
         # If ansible vault fails, use the new data instead of crashing
         try:
-            if i < len(original_data):
-                reencrypted_data[i] = compare_and_update(
-                    original_data=original_data[i],
-                    reencrypted_data=reencrypted_data[i],
-                )
-            else:
-                reencrypted_data[i] = reencrypted_data[i]
+            result = _compare_vaulted_value(original_data[i], item, vault)
         except (AnsibleError, AnsibleVaultError):
-            reencrypted_data[i] = reencrypted_data[i]
+            continue
+        if result is not item:
+            reencrypted_data[i] = result
+
+
+def _compare_vaulted_value(original_data: Any, reencrypted_data: Any, vault: VaultLib) -> Any:
+    """Helper function for compare_and_update. Decides which version of a single value to keep"""
+    if (
+        isinstance(original_data, TaggedScalar)
+        and hasattr(original_data, "original_vault")
+        and isinstance(reencrypted_data, TaggedScalar)
+        and reencrypted_data.tag.value == "!vault"
+    ):
+        # Always return the same original object, so aliases to it are still aliases
+        original_vault = original_data.original_vault
+        if isinstance(reencrypted_data, PendingEncryption):
+            # Not encrypted yet, so compare the plaintext with the original plaintext (already
+            # decrypted and cached when the file was loaded). Values are only encrypted without a
+            # label when using the default vault-id
+            label = "" if reencrypted_data.vault_id == "default" else reencrypted_data.vault_id
+            if (
+                extract_vault_label(original_vault.value) == label
+                and _decrypt_cached(vault, original_vault.value)
+                == reencrypted_data.plaintext.encode("utf-8")
+            ):
+                return original_vault
+            return reencrypted_data
+        if extract_vault_label(original_vault.value) != extract_vault_label(reencrypted_data.value):
+            return reencrypted_data
+        # Identical ciphertext means identical plaintext, no need to decrypt anything
+        if original_vault.value == reencrypted_data.value:
+            return original_vault
+        # The original value was already decrypted (and cached) when the file was loaded
+        if (
+            _decrypt_cached(vault, original_vault.value)
+            == _decrypt_cached(vault, reencrypted_data.value)
+        ):
+            return original_vault
 
-    return original_data, reencrypted_data
+    return reencrypted_data
 
 
 def compare_and_update(
     original_data: Union[CommentedMap | CommentedSeq | TaggedScalar],
     reencrypted_data: Union[CommentedMap | CommentedSeq | TaggedScalar],
+    vault: VaultLib,
 ) -> Union[CommentedMap | CommentedSeq | TaggedScalar]:
     """Take the new and original data, find each !vault entry, and if it exists in the original
-    data, decrypt both and compare them. If they are the same, prefer the original data, to prevent
-    useless diffs. Will consider values different if the new and old values have different vault-id
-    labels. Will also ensure that there is a newline after a vaulted variable (for readability)
-    """
+    data, decrypt both and compare them. If they are the same, prefer the original encrypted value,
+    to prevent useless diffs. Will consider values different if the new and old values have
+    different vault-id labels. Will also ensure that there is a newline after a vaulted variable
+    (for readability).
 
-    # Loop recursively through everything
-    if is_commented_map(original_data) and is_commented_map(reencrypted_data):
-        original_data, reencrypted_data = _process_commented_map(
-            original_data, reencrypted_data  # type: ignore[arg-type]
-        )
-    elif is_commented_seq(original_data) and is_commented_seq(reencrypted_data):
-        original_data, reencrypted_data = _process_commented_seq(
-            original_data, reencrypted_data  # type: ignore[arg-type]
-        )
+    The original data is the data loaded by read_encrypted_yaml_file(), where the vaulted values
+    remember their original !vault value.
+    """
 
-    elif (
-        is_tagged_scalar(original_data)
-        and original_data.tag.value == "!vault"
-        and is_tagged_scalar(reencrypted_data)
-        and reencrypted_data.tag.value == "!vault"
-    ):
-        if (
-            VAULT.decrypt(original_data.value) == VAULT.decrypt(reencrypted_data.value) and
-            extract_vault_label(original_data.value) == extract_vault_label(reencrypted_data.value)
-        ):
-            return original_data
+    # Walk through everything with a list of nodes left to process instead of recursing, which
+    # saves a function call per nested dict/list and can't hit the recursion limit
+    to_process = [(original_data, reencrypted_data)]
+    # Aliased dicts/lists only need to be processed once (and recursive ones would never end)
+    processed = set()
+    while to_process:
+        original, reencrypted = to_process.pop()
+        if id(reencrypted) in processed:
+            continue
+        processed.add(id(reencrypted))
+        if isinstance(original, CommentedMap) and isinstance(reencrypted, CommentedMap):
+            _process_commented_map(original, reencrypted, to_process, vault)
+        elif isinstance(original, CommentedSeq) and isinstance(reencrypted, CommentedSeq):
+            _process_commented_seq(original, reencrypted, to_process, vault)
 
-    return reencrypted_data
+    return _compare_vaulted_value(original_data, reencrypted_data, vault)
 
 
 def ensure_newline(data: Union[CommentedMap, CommentedSeq], key: "str") -> None:
-    """Utility script, to avoid having to write it twice in the recursive _process_commented*()
-    functions above"""
+    """Utility script, to avoid having to write it twice in the _process_commented*() functions
+    above, which compare_and_update() calls for each dict and list it walks through"""
     comment_nextline = data.ca.items.get(key)
     # Ensure that there is at least one newline after the vaulted value, for readability
     if comment_nextline is None:
-        data.ca.items[key] = [None, None, None, None]
-        # All this just to make a newline... not 100% sure how this StringMark
-        # stuff works
-        newline_token = CommentToken(
-            "\n",
-            start_mark=StringMark(
-                buffer=data, pointer=0, name=None, index=0, line=0, column=0
-            ),
-            end_mark=StringMark(
-                buffer=data, pointer=1, name=None, index=1, line=0, column=1
-            ),
-        )
-        data.ca.items[key][2] = newline_token
+        # The token is copied, in case ruamel changes it later on
+        data.ca.items[key] = [None, None, copy.copy(_NEWLINE_TOKEN), None]
 
 
 def yaml_set_anchor(self, value, always_dump=True):
@@ -430,9 +564,11 @@ def yaml_set_anchor(self, value, always_dump=True):
     self.anchor.value = value
     self.anchor.always_dump = always_dump
 
-def setup_yaml() -> YAML:
+def setup_yaml(constructor: type = RoundTripConstructor) -> YAML:
     """Set up the neccesary yaml loader stuff"""
     yaml = YAML()
+    # Use a specific constructor class, if the loader needs its own custom constructors
+    yaml.Constructor = constructor
     # Don't strip out unneccesary quotes around scalar variables
     yaml.preserve_quotes = True
     # Prevent the yaml dumper from line-breaking the longer variables
@@ -443,39 +579,77 @@ def setup_yaml() -> YAML:
     yaml.explicit_end = True
     # Ensure list items are indented by two, but not inline with the parent variable
     yaml.indent(mapping=2, sequence=4, offset=2)
-    # Override the yaml_set_anchor to keep anchors even if they are unused
-    CommentedBase.yaml_set_anchor = yaml_set_anchor
 
     return yaml
 
 
-def read_encrypted_yaml_file(file: Path) -> Any:
-    """Add a custom constructor to decrypt vault, and load the content. Used for the initial
-    decryption of the file"""
-    yaml = setup_yaml()
-    yaml.constructor.add_constructor("!vault", constructor_tmp_decrypt)
-    with open(file, "r", encoding="utf-8") as file_to_decrypt:
-        return yaml.load(file_to_decrypt)
+# Override the yaml_set_anchor to keep anchors even if they are unused. Only needs to be done once
+CommentedBase.yaml_set_anchor = yaml_set_anchor
+
+
+class _DecryptConstructor(RoundTripConstructor):
+    """Constructor used when loading the file before opening the editor. ruamel.yaml registers
+    constructors on the class, not on the YAML object, so each step gets its own subclass to keep
+    the custom constructors from leaking into the other steps. The vault is set on the constructor
+    object before loading, and the custom constructors get it from there"""
+    vault: VaultLib = None
+
 
+class _ReencryptConstructor(RoundTripConstructor):
+    """Constructor used when loading the file after closing the editor"""
+    vault: VaultLib = None
 
-def read_yaml_file(file: Path) -> Any:
-    """Load the yaml file, mainly just to verify that this is a file, and that it is a valid yaml
-    file
+
+# Decrypt the vaulted values, or tag them to show why they couldn't be decrypted
+_DecryptConstructor.add_constructor("!vault", constructor_tmp_decrypt)
+
+# Let the yaml loader do the reencrypting for you. Multiconstructors are used for when the tag
+# might include a vault-id
+_ReencryptConstructor.add_multi_constructor(
+    f"{TAG_NAME_DECRYPTED_SUCCESS}{TAG_SEPARATOR_VAULTID}",
+    constructor_tmp_encrypt
+)
+_ReencryptConstructor.add_constructor(TAG_NAME_DECRYPTED_SUCCESS, constructor_tmp_encrypt)
+# Also translate the temporary tags added in constructor_tmp_decrypt() back to the original values
+_ReencryptConstructor.add_multi_constructor(TAG_NAME_UNKNOWN_LABEL, constructor_tmp_invalid)
+_ReencryptConstructor.add_multi_constructor(TAG_NAME_INVALID_VAULT_FORMAT, constructor_tmp_invalid)
+_ReencryptConstructor.add_constructor(TAG_NAME_COULD_NOT_DECRYPT, constructor_tmp_invalid)
+# In case someone pastes vault-encrypted variables when in the vaulti editor, keep them as they are
+_ReencryptConstructor.add_constructor("!vault", constructor_tmp_invalid)
+
+# Building a YAML object isn't free, so set them up once and reuse them for every file. One for
+# plain loading/dumping, and one each for the decrypting and reencrypting steps
+_YAML_PLAIN = setup_yaml()
+_YAML_DECRYPT = setup_yaml(_DecryptConstructor)
+_YAML_REENCRYPT = setup_yaml(_ReencryptConstructor)
+
+
+def read_encrypted_yaml_file(file: Path, vault: VaultLib) -> Any:
+    """Load the content with the custom constructor to decrypt vault. Used for the initial
+    decryption of the file. This is the only time the file is parsed; the decrypted values remember
+    their original encrypted value, so the same data is used for comparing after editing.
+    The document is composed first, so the vault values can be decrypted in parallel before
+    constructing it.
     """
-    yaml = setup_yaml()
     try:
-        with open(file, "r", encoding="utf-8") as file_to_read:
-            return yaml.load(file_to_read)
+        # Text mode, so CRLF line endings are normalized (ruamel.yaml keeps the \r in comments)
+        with open(file, "r", encoding="utf-8") as file_to_decrypt:
+            node = _YAML_DECRYPT.compose(file_to_decrypt)
     except IsADirectoryError as err:
         print(f"Specified file is a directory. Error is:\n{err}", file=sys.stderr)
         sys.exit(1)
+    if node is None:
+        return None
+    prefetch_vault_values(node, vault)
+    # The constructors find the vault on the constructor object (their first argument)
+    _YAML_DECRYPT.constructor.vault = vault
+    return _YAML_DECRYPT.constructor.construct_document(node)
 
 
 def display_yaml_data(yaml_data: Union[Path, StreamType]) -> None:
     """Dumps the unencrypted content to stdout without opening an editor. Useful when you want to
     pipe it to something else, use it for git textconv, etc."""
-    yaml = setup_yaml()
-    yaml.dump(data=yaml_data, stream=sys.stdout)
+    _YAML_PLAIN.dump(data=yaml_data, stream=sys.stdout)
 
 
 def _get_default_editor() -> List[str]:
@@ -501,62 +675,106 @@ def open_file_in_default_editor(file_name: Path) -> None:
 
 def write_data_to_temporary_file(data_to_write: Union[Path, StreamType]) -> Path:
     """Write the yaml contents to a temporary file, for editing"""
-    yaml = setup_yaml()
-    # Create a temporary file
-    with tempfile.NamedTemporaryFile(
-        mode="w", delete=False, prefix="vaultedit_", suffix=".yaml"
-    ) as temp_file:
-        yaml.dump(data_to_write, temp_file)
-        return Path(temp_file.name)
-
-def constructor_tmp_encrypt_multi(loader, _tag_suffix: str, node: ScalarNode) -> TaggedScalar:
-    """Wrapper function for the multiconstructor. The multiconstructor requires a function which 
-    has a parameter that takes the tag_suffix variable. Since we are not using the suffix in this
-    case, we just pass it to our standard constructor function, dropping the tag_suffix variable"""
-    return constructor_tmp_encrypt(loader, node, tag_suffix=_tag_suffix)
-
-def constructor_tmp_invalid_multi(loader, _tag_suffix: str, node: ScalarNode) -> TaggedScalar:
-    """Wrapper function for the multiconstructor. The multiconstructor requires a function which 
-    has a parameter that takes the tag_suffix variable. Since we are not using the suffix in this
-    case, we just pass it to our standard constructor function, dropping the tag_suffix variable"""
-    return constructor_tmp_invalid(loader, node)
+    # Create a temporary file (only readable by the user, and not inherited by child processes).
+    # The emitter does lots of small writes, so give it a large buffer to cut down on syscalls.
+    # Binary, since ruamel.yaml encodes to utf-8 itself when given a binary stream
+    fd, temp_filename = tempfile.mkstemp(prefix="vaultedit_", suffix=".yaml")
+    with os.fdopen(fd, "wb", buffering=_WRITE_BUFFER_SIZE) as temp_file:
+        _YAML_PLAIN.dump(data_to_write, temp_file)
+    return Path(temp_filename)
+
+def has_commented_secret(text: str) -> bool:
+    """Checks whether a decrypted secret tag shows up after a # on any line. Only jumps between
+    the # characters with str.find, which is a lot cheaper than running a regex over the whole text
+    """
+    comment_start = text.find("#")
+    while comment_start != -1:
+        end_of_line = text.find("\n", comment_start)
+        if end_of_line == -1:
+            end_of_line = len(text)
+        if text.find(TAG_NAME_DECRYPTED_SUCCESS, comment_start, end_of_line) != -1:
+            return True
+        comment_start = text.find("#", end_of_line)
+    return False
+
+
+def _write_file_in_place(file: str, data: bytes) -> None:
+    """Overwrite the content of an existing file, keeping its inode (owner, links, etc.)"""
+    with open(file, "wb") as current_file:
+        current_file.write(data)
+
+
+def write_file_atomically(file: Path, text: str) -> None:
+    """Replace the content of a file, without ever leaving a half-written file behind. The text is
+    written to a temporary file next to it (same filesystem), which is then moved over the original.
+    Nothing is written if the file already has this content, like when the edits were reverted.
+
+    Replacing the file needs write access to the directory, and gives the file a new inode, so
+    extended attributes and ACLs on the original file are not kept. If the directory isn't
+    writable, the owner can't be kept, or the file has hard links, the file is just overwritten in
+    place instead. Same if the file itself isn't writable, so a read-only file still fails with a
+    PermissionError instead of being replaced."""
+    logger = logging.getLogger("Vaulti")
+    # Replace the target of a symlink, not the symlink itself
+    real_file = os.path.realpath(file)
+    data = text.encode("utf-8")
+    try:
+        with open(real_file, "rb") as current_file:
+            if current_file.read() == data:
+                logger.info("Content of %s is unchanged, not writing it", file)
+                return
+            original_stat = os.fstat(current_file.fileno())
+    except FileNotFoundError:
+        original_stat = None
+
+    # Renaming only needs access to the directory, so check the file's own permissions first.
+    # Hard links would keep pointing to the old file after renaming
+    if original_stat is not None and (
+        original_stat.st_nlink > 1 or not os.access(real_file, os.W_OK)
+    ):
+        logger.info("%s has hard links or is not writable, writing it in place", file)
+        _write_file_in_place(real_file, data)
+        return
+
+    try:
+        fd, temp_filename = tempfile.mkstemp(prefix=".vaulti_", dir=os.path.dirname(real_file))
+    except OSError as err:
+        logger.info("Could not create a temp file next to %s, writing in place: %s", file, err)
+        _write_file_in_place(real_file, data)
+        return
+
+    try:
+        # Already in one piece, so it is written with a single write and needs no extra buffering
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        if original_stat is not None:
+            # The temporary file belongs to whoever runs vaulti (for example root, with sudo), so
+            # give it back to the original owner. Do this before chmod, since chown can reset the
+            # setuid/setgid bits
+            temp_stat = os.stat(temp_filename)
+            if (temp_stat.st_uid, temp_stat.st_gid) != (original_stat.st_uid, original_stat.st_gid):
+                os.chown(temp_filename, original_stat.st_uid, original_stat.st_gid)
+            # mkstemp only gives access to the user, so keep the permissions of the original file
+            os.chmod(temp_filename, original_stat.st_mode & 0o7777)
+        os.replace(temp_filename, real_file)
+    except OSError as err:
+        os.unlink(temp_filename)
+        logger.info("Could not replace %s, writing it in place: %s", file, err)
+        _write_file_in_place(real_file, data)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+
 
 def encrypt_and_write_tmp_file(
-    tmp_file: Path, final_file: Path, original_data: CommentedMap
+    tmp_file: Path, final_file: Path, original_data: CommentedMap, vault: VaultLib
 ) -> None:
     """Reencrypts yaml data and writes it to a file using lots of custom constructors. Also ensures
     that the user gets a chance to reopen invalid files, etc."""
 
-    yaml = setup_yaml()
-
-
-    # Register the constructor to let the yaml loader do the
-    # reencrypting for you Adding it this late to avoid encryption step
-    # before the editor opens
-    yaml.constructor.add_multi_constructor(
-        f"{TAG_NAME_DECRYPTED_SUCCESS}{TAG_SEPARATOR_VAULTID}",
-        constructor_tmp_encrypt_multi
-    )
-
-    # Also register constructors for the temporary tags added in constructor_tmp_decrypt()
-    # Multiconstructors used for when the tag might includes a vault-id
-    yaml.constructor.add_multi_constructor(
-        TAG_NAME_UNKNOWN_LABEL,
-        constructor_tmp_invalid_multi
-    )
-    yaml.constructor.add_multi_constructor(
-        TAG_NAME_INVALID_VAULT_FORMAT,
-        constructor_tmp_invalid_multi
-    )
-    yaml.constructor.add_constructor(TAG_NAME_DECRYPTED_SUCCESS, constructor_tmp_encrypt)
-    yaml.constructor.add_constructor(TAG_NAME_COULD_NOT_DECRYPT, constructor_tmp_invalid)
-
-    # Not sure why I need to override the constructor for the !vault tag, since this is using
-    # another yaml object than the one where the constructor was added, , but apparently it is
-    # needed. Adding it in case someone pastes vault-encrypted variables when in the vaulti editor,
-    # and we need to prevent the yaml library from decrypting and putting the unencrypted value in
-    # the final file.
-    yaml.constructor.add_constructor("!vault", constructor_tmp_invalid)
+    # The constructors doing the reencryption are registered on this one
+    yaml = _YAML_REENCRYPT
+    yaml.constructor.vault = vault
 
     def prompt_user_action() -> str:
         while True:
@@ -572,42 +790,53 @@ def encrypt_and_write_tmp_file(
     # Give the user a chance to re-open the file if the yaml could not be parsed
     is_file_parsed = False
     while not is_file_parsed:
-        with open(tmp_file, "r", encoding="utf-8") as file:
-            try:
-                edited_data = yaml.load(file)
-                is_file_parsed = True
-            except (ScannerError, ParserError, ValueError,
-                    DuplicateKeyError, ConstructorError) as err:
-                if err is ValueError:
-                    print(f"Encountered Vault ID which has not been loaded. Error is:\n{err}")
-                else:
-                    print(f"The edited file is no longer valid YAML. Error is:\n{err}")
-                print("What would you like to do?")
-                user_retry = prompt_user_action()
-
-                if user_retry == 'e':
-                    open_file_in_default_editor(tmp_file.absolute())
-                elif user_retry == 'd':
-                    print("Changes discarded. Exiting")
-                    sys.exit(0)
-            except AnsibleError as err:
-                print(f"AnsibleError. Error is:\n{err}", file=sys.stderr)
-                sys.exit(1)
+        # Read it all in one go, instead of letting the parser read from the file in small pieces.
+        # Text, so CRLF line endings from the editor are normalized (ruamel.yaml keeps the \r in
+        # comments)
+        edited_content = StringIO(tmp_file.read_text(encoding="utf-8"))
+        # ruamel.yaml takes the file name for error messages from the stream
+        edited_content.name = str(tmp_file)
+        try:
+            edited_data = yaml.load(edited_content)
+            is_file_parsed = True
+        except (ScannerError, ParserError, ValueError,
+                DuplicateKeyError, ConstructorError) as err:
+            if err is ValueError:
+                print(f"Encountered Vault ID which has not been loaded. Error is:\n{err}")
+            else:
+                print(f"The edited file is no longer valid YAML. Error is:\n{err}")
+            print("What would you like to do?")
+            user_retry = prompt_user_action()
+
+            if user_retry == 'e':
+                open_file_in_default_editor(tmp_file.absolute())
+            elif user_retry == 'd':
+                print("Changes discarded. Exiting")
+                sys.exit(0)
+        except AnsibleError as err:
+            print(f"AnsibleError. Error is:\n{err}", file=sys.stderr)
+            sys.exit(1)
 
     # Loop through all the values of the new data, making sure that
     # any encrypted data unchanged from the original still uses the
     # original vault encrypted data. This makes your git diffs much
     # cleaner.
-    final_data = compare_and_update(original_data, edited_data)
-    # Then write the final data back to the original file
-    with open(final_file, "w", encoding="utf-8") as file:
-        yaml.dump(final_data, file)
+    final_data = compare_and_update(original_data, edited_data, vault)
+    # Then write the final data back to the original file. Changed values are encrypted while
+    # dumping, so dump to memory first to avoid leaving a half-written file if that fails
+    buffer = StringIO()
+    try:
+        yaml.dump(final_data, buffer)
+    except AnsibleError as err:
+        print(f"AnsibleError. Error is:\n{err}", file=sys.stderr)
+        sys.exit(1)
+    final_text = buffer.getvalue()
+    write_file_atomically(final_file, final_text)
 
     # A common mistake is to comment out a decrypted secret line,
     # making it plaintext. Ensure the user is notified of this.
-    with open(final_file, "r", encoding="utf-8") as file:
-        content = file.read()
-    if re.search(r".*#.*" + re.escape(TAG_NAME_DECRYPTED_SUCCESS) + r".*", content):
+    # The dumped text is still in memory, so no need to read the file again
+    if has_commented_secret(final_text):
         print(
             (f"WARNING! The final file '{final_file}' seems to have secrets that were not "
               "reencrypted due to being commented out in the editor! Search the file for "
@@ -676,7 +905,9 @@ def parse_arguments() -> Namespace:
     return parser.parse_args()
 
 
-def main_loop(filenames: Iterable[Path], view_only: bool, force_create: bool) -> None:
+def main_loop(
+    filenames: Iterable[Path], vault: VaultLib, view_only: bool, force_create: bool
+) -> None:
     """Loop through each file specified as params"""
     logger = logging.getLogger("Vaulti")
     for filename in filenames:
@@ -686,19 +917,19 @@ def main_loop(filenames: Iterable[Path], view_only: bool, force_create: bool) ->
         # Has the file been created by this script?
         file_force_created = False
 
-        # Read the original file without custom constructors (for comparing
-        # later) (Deepcopy doesn't seem to work, so just load it before
-        # defining custom constructors
+        # Load the yaml file into memory (will auto-decrypt vault because of the constructors).
+        # This is also used as the original data to compare with later, since the decrypted
+        # values keep track of their original encrypted values
         try:
-            original_data = read_yaml_file(filename)
+            decrypted_data = read_encrypted_yaml_file(filename, vault)
         except ScannerError as err:
             print(f"'{filename}' is not a valid YAML file. Error is\n{err}", file=sys.stderr)
             sys.exit(1)
         except FileNotFoundError:
             if force_create:
                 logger.info("--force specified as parameter, creating file %s", filename)
-                with open(filename, "x", encoding="utf-8") as empty_file:
-                    original_data = empty_file
+                with open(filename, "x", encoding="utf-8"):
+                    decrypted_data = None
                 file_force_created = True
             else:
                 print(
@@ -707,10 +938,6 @@ def main_loop(filenames: Iterable[Path], view_only: bool, force_create: bool) ->
                 )
                 sys.exit(1)
 
-        # Load the yaml file into memory (will now auto-decrypt vault because
-        # of the constructors)
-        decrypted_data = read_encrypted_yaml_file(filename)
-
         if view_only:
             logger.info("--view specified as parameter, will display and exit")
             display_yaml_data(decrypted_data)
@@ -721,16 +948,22 @@ def main_loop(filenames: Iterable[Path], view_only: bool, force_create: bool) ->
         try:
             temp_filename = write_data_to_temporary_file(decrypted_data)
             logger.info("Created temporary file %s", temp_filename)
-            created_time = os.stat(temp_filename).st_ctime
+            created_stat = os.stat(temp_filename)
+            created_key = (created_stat.st_mtime_ns, created_stat.st_size)
             open_file_in_default_editor(temp_filename.absolute())
-            # Don't do anything if the file hasn't been changed since its creation
-            changed_time = os.stat(temp_filename).st_ctime
-            if created_time != changed_time:
+            # Don't do anything if the file hasn't been changed since its creation. This skips
+            # the whole reparse/reencrypt step, which is the expensive part. Use the modification
+            # time, since the ctime also changes on metadata-only changes like chmod. The size is
+            # compared too, in case the filesystem timestamps are too coarse to tell
+            changed_stat = os.stat(temp_filename)
+            changed_key = (changed_stat.st_mtime_ns, changed_stat.st_size)
+            if created_key != changed_key:
                 logger.info("File was saved after being created, continuing")
                 encrypt_and_write_tmp_file(
                     tmp_file=temp_filename,
                     final_file=filename,
-                    original_data=original_data,
+                    original_data=decrypted_data,
+                    vault=vault,
                 )
             else:
                 # If the file was created but never changed, delete it
@@ -745,17 +978,13 @@ def main_loop(filenames: Iterable[Path], view_only: bool, force_create: bool) ->
 def main() -> None:
     """Parse arguments and set up logging before moving on to the main loop"""
     args = parse_arguments()
-    # Need to use the VAULT variable in the custom constructors, and I couldn't figure
-    # out how to pass it as an extra parameter to the add_constructor function
-    # pylint: disable=global-statement
-    global VAULT
 
     logging.basicConfig(level=args.loglevel, format="%(levelname)s: %(message)s")
     logger = logging.getLogger("Vaulti")
     logger.info("Initializing vault setup")
 
     try:
-        VAULT = setup_vault(
+        vault = setup_vault(
                     ask_vault_pass=args.ask_vault_pass,
                     vault_password_file=args.vault_password_file,
                     vault_ids=args.vault_id
@@ -764,7 +993,7 @@ def main() -> None:
         logger.info("User interrupted process, exiting")
         sys.exit(0)
 
-    main_loop(args.files, view_only=args.view, force_create=args.force)
+    main_loop(args.files, vault, view_only=args.view, force_create=args.force)
 
 
 if __name__ == "__main__":
@@ -61,3 +61,240 @@ up: !vault |
         raise AssertionError("File did not get changed as expected")
 
 
+@nox.session
+def test_reencrypt_changed_secret(session):
+    """ This tests for whether only the edited vaulted value is reencrypted, while the untouched
+    one keeps its original ciphertext """
+
+    vault_pass = "default"
+    vault = VaultLib([("default", VaultSecret(vault_pass.encode("utf-8")))])
+    untouched_vaulttext = vault.encrypt("keep me").decode("utf-8")
+    changed_vaulttext = vault.encrypt("change me").decode("utf-8")
+
+    yaml_content_initial = f"""---
+untouched: !vault |
+{indent(untouched_vaulttext)}
+
+changed: !vault |
+{indent(changed_vaulttext)}
+...
+"""
+
+    with open("test2_password.txt", "w", encoding="utf-8") as f:
+        f.write(vault_pass)
+    with open("test2_initial.yaml", "w", encoding="utf-8") as f:
+        f.write(yaml_content_initial)
+
+    # Run vaulti, editing only one of the secrets with sed
+    session.env["VISUAL"] = "sed -i s/change.me/changed/"
+    session.env["ANSIBLE_VAULT_PASSWORD_FILE"] = "test2_password.txt"
+    session.run("bash", "-c", "vaulti test2_initial.yaml", external=True)
+
+    with open("test2_initial.yaml", "r", encoding="utf-8") as f:
+        yaml_content_final = f.read()
+    data = YAML().load(yaml_content_final)
+    os.remove("test2_initial.yaml")
+    os.remove("test2_password.txt")
+
+    # The untouched value must be exactly the same, the changed one must be reencrypted
+    if f"untouched: !vault |\n{indent(untouched_vaulttext)}\n" not in yaml_content_final:
+        raise AssertionError("Untouched vaulted value did not keep its original ciphertext")
+    if not isinstance(data["changed"], TaggedScalar) or data["changed"].tag.value != "!vault":
+        raise AssertionError("Changed value did not get reencrypted")
+    if data["changed"].value.strip() == changed_vaulttext.strip():
+        raise AssertionError("Changed value still has its original ciphertext")
+    if vault.decrypt(data["changed"].value) != b"changed":
+        raise AssertionError("Changed value did not decrypt to the new value")
+
+
+def indent(vaulttext):
+    """ Indents an encrypted value, for use as a block scalar in the yaml files """
+    return "\n".join(f"  {line}" for line in vaulttext.splitlines())
+
+
+def write_vault_id_test_files(prefix):
+    """ Writes a default and a foo password file, and a yaml file with a variable encrypted with
+    each of them. Returns the file names """
+    vault = VaultLib([
+        ("default", VaultSecret(b"default")),
+        ("foo", VaultSecret(b"foo")),
+    ])
+    default_vaulttext = vault.encrypt("default secret", vault_id="default").decode("utf-8")
+    foo_vaulttext = vault.encrypt(
+        "foo secret", secret=VaultSecret(b"foo"), vault_id="foo"
+    ).decode("utf-8")
+
+    files = {
+        "default": f"{prefix}_default.txt",
+        "foo": f"{prefix}_foo.txt",
+        "yaml": f"{prefix}_initial.yaml",
+    }
+    with open(files["default"], "w", encoding="utf-8") as f:
+        f.write("default")
+    with open(files["foo"], "w", encoding="utf-8") as f:
+        f.write("foo")
+    with open(files["yaml"], "w", encoding="utf-8") as f:
+        f.write(f"""---
+default_var: !vault |
+{indent(default_vaulttext)}
+
+foo_var: !vault |
+{indent(foo_vaulttext)}
+...
+""")
+    return files
+
+
+@nox.session
+def test_view_with_vault_id(session):
+    """ This tests for whether --vault-id is used when decrypting """
+
+    files = write_vault_id_test_files("test3")
+    try:
+        output = session.run(
+            "bash", "-c",
+            f"vaulti --view {files['yaml']} --vault-id default@{files['default']} "
+            f"--vault-id foo@{files['foo']}",
+            external=True, silent=True,
+        )
+    finally:
+        for file in files.values():
+            os.remove(file)
+
+    if "default_var: !ENCRYPT default secret" not in output:
+        raise AssertionError(f"Default vault-id value was not decrypted:\n{output}")
+    if "foo_var: !ENCRYPT:foo foo secret" not in output:
+        raise AssertionError(f"Labeled vault-id value was not decrypted:\n{output}")
+
+
+@nox.session
+def test_view_with_vault_password_file(session):
+    """ This tests for whether --vault-password-file is used for the default vault id, even
+    without any --vault-id """
+
+    files = write_vault_id_test_files("test4")
+    try:
+        output = session.run(
+            "bash", "-c",
+            f"vaulti --view {files['yaml']} --vault-password-file {files['default']}",
+            external=True, silent=True,
+        )
+    finally:
+        for file in files.values():
+            os.remove(file)
+
+    if "default_var: !ENCRYPT default secret" not in output:
+        raise AssertionError(f"Value was not decrypted with the password file:\n{output}")
+    # The foo vault id wasn't loaded, so this one can't be decrypted
+    if "foo_var: !UNKNOWN_VAULT_ID_LABEL:foo" not in output:
+        raise AssertionError(f"Value with unknown vault id was not tagged as such:\n{output}")
+
+
+def write_edit_test_files(prefix):
+    """ Writes a password file and a yaml file with a plain and a vaulted variable, formatted the
+    way vaulti writes it. Returns the file names """
+    vault = VaultLib([("default", VaultSecret(b"default"))])
+    vaulttext = vault.encrypt("secret").decode("utf-8")
+    files = {
+        "password": f"{prefix}_password.txt",
+        "yaml": f"{prefix}_initial.yaml",
+    }
+    with open(files["password"], "w", encoding="utf-8") as f:
+        f.write("default")
+    with open(files["yaml"], "w", encoding="utf-8") as f:
+        f.write(f"""---
+plain: before
+secret: !vault |
+{indent(vaulttext)}
+
+...
+""")
+    return files
+
+
+@nox.session
+def test_edit_through_symlink(session):
+    """ This tests for whether editing a symlinked file changes the file it points to, and keeps
+    the symlink """
+
+    files = write_edit_test_files("test5")
+    files["link"] = "test5_link.yaml"
+    os.symlink(files["yaml"], files["link"])
+    try:
+        session.env["VISUAL"] = "sed -i s/before/after/"
+        session.env["ANSIBLE_VAULT_PASSWORD_FILE"] = files["password"]
+        session.run("bash", "-c", f"vaulti {files['link']}", external=True)
+
+        if not os.path.islink(files["link"]):
+            raise AssertionError("Symlink was replaced by a regular file")
+        with open(files["yaml"], "r", encoding="utf-8") as f:
+            if "plain: after" not in f.read():
+                raise AssertionError("File behind the symlink did not get changed")
+    finally:
+        for file in files.values():
+            os.remove(file)
+
+
+@nox.session
+def test_edit_hard_linked_file(session):
+    """ This tests for whether a file with hard links is changed in place, so all the links still
+    point to the same (changed) file """
+
+    files = write_edit_test_files("test6")
+    files["link"] = "test6_link.yaml"
+    os.link(files["yaml"], files["link"])
+    try:
+        session.env["VISUAL"] = "sed -i s/before/after/"
+        session.env["ANSIBLE_VAULT_PASSWORD_FILE"] = files["password"]
+        session.run("bash", "-c", f"vaulti {files['yaml']}", external=True)
+
+        if not os.path.samefile(files["yaml"], files["link"]):
+            raise AssertionError("Hard link does not point to the edited file anymore")
+        with open(files["link"], "r", encoding="utf-8") as f:
+            if "plain: after" not in f.read():
+                raise AssertionError("Hard linked file did not get changed")
+    finally:
+        for file in files.values():
+            os.remove(file)
+
+
+@nox.session
+def test_edit_keeps_file_mode(session):
+    """ This tests for whether the permissions of the edited file are kept """
+
+    files = write_edit_test_files("test7")
+    os.chmod(files["yaml"], 0o640)
+    try:
+        session.env["VISUAL"] = "sed -i s/before/after/"
+        session.env["ANSIBLE_VAULT_PASSWORD_FILE"] = files["password"]
+        session.run("bash", "-c", f"vaulti {files['yaml']}", external=True)
+
+        with open(files["yaml"], "r", encoding="utf-8") as f:
+            if "plain: after" not in f.read():
+                raise AssertionError("File did not get changed")
+        mode = os.stat(files["yaml"]).st_mode & 0o7777
+        if mode != 0o640:
+            raise AssertionError(f"File mode changed from 0o640 to {oct(mode)}")
+    finally:
+        for file in files.values():
+            os.remove(file)
+
+
+@nox.session
+def test_noop_save_keeps_mtime(session):
+    """ This tests for whether saving without changing anything leaves the file alone """
+
+    files = write_edit_test_files("test8")
+    # Set an old modification time, so any write would be noticed
+    os.utime(files["yaml"], ns=(1_000_000_000_000_000_000, 1_000_000_000_000_000_000))
+    try:
+        # Touching the file makes vaulti go through the whole reencrypt step
+        session.env["VISUAL"] = "touch"
+        session.env["ANSIBLE_VAULT_PASSWORD_FILE"] = files["password"]
+        session.run("bash", "-c", f"vaulti {files['yaml']}", external=True)
+
+        if os.stat(files["yaml"]).st_mtime_ns != 1_000_000_000_000_000_000:
+            raise AssertionError("File was written even though nothing changed")
+    finally:
+        for file in files.values():
+            os.remove(file)